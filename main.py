@@ -1,21 +1,74 @@
 import os
-import json
 import aiohttp
+import orjson
 import asyncio
+import bisect
+import re
 import shutil
+import threading
 import time
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
-from typing import Dict, List
-from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from datetime import date, datetime, timezone, timedelta
 from icalendar import Calendar
 from PIL import Image, ImageDraw, ImageFont
 from astrbot.core.star import Star, Context, StarTools
 from astrbot.api import logger
+import astrbot.api.message_components as Comp
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.event.filter import event_message_type, EventMessageType
 from astrbot.core.utils.io import download_file
 from pathlib import Path
+from zoneinfo import ZoneInfo
+
+# 上海时区 (UTC+8)，课程时间统一转换到该时区
+SHANGHAI_TZ = timezone(timedelta(hours=8))
+
+# 只匹配插件用到的 VEVENT 属性：名称、参数、值
+ICS_PROP_RE = re.compile(rb"^(SUMMARY|LOCATION|DTSTART|DTEND)((?:;[^:]*)?):(.*)$")
+ICS_TZID_RE = re.compile(rb";TZID=\"?([^;:\"]+)")
+
+# 头像缓存有效期（秒）：内存 1 小时，磁盘 1 天
+AVATAR_MEM_TTL = 3600
+AVATAR_DISK_TTL = 86400
+
+# 绑定请求的有效期（秒），以及后台清理过期请求的间隔（秒）
+BINDING_TIMEOUT = 60
+BINDING_REAP_INTERVAL = 10
+
+# 用户数据延迟写入的间隔（秒），期间的多次修改合并为一次写入
+USER_DATA_SAVE_DELAY = 5
+
+
+@dataclass(slots=True)
+class Course:
+    """一节课程"""
+    summary: Optional[str]
+    location: Optional[str]
+    start_time: datetime
+    end_time: datetime
+
+
+@dataclass(slots=True)
+class TodayCourse(Course):
+    """当日课表中的一节课程，带有预先格式化的 HH:MM 起止时间"""
+    start_hm: str
+    end_hm: str
+
+
+@dataclass(slots=True)
+class GroupEntry:
+    """群友课表中的一行：课程及其所属用户"""
+    course: TodayCourse
+    user_id: str
+    nickname: str
+
+
+# 某一天的课程：(开始时间列表, 最晚结束时间列表, 最晚结束课程下标列表, 课程列表)，均按开始时间排序
+# 最晚结束时间/下标是前 i+1 节课中结束最晚的那一节，用于在课程重叠时找出正在进行的课
+TodaySchedule = Tuple[List[datetime], List[datetime], List[int], List[TodayCourse]]
 
 
 class Main(Star):
@@ -29,10 +82,48 @@ class Main(Star):
         self.data_path: Path = StarTools.get_data_dir()
         self.ics_path: Path = self.data_path / "ics"
         self.user_data_file: Path = self.data_path / "userdata.json"
+        self.avatar_path: Path = self.data_path / "avatars"
 
         self._init_data()
         self.user_data = self._load_user_data()
+        # 课表文件路径索引：(群号, QQ号) -> 文件路径，绑定时更新
+        self._path_index: Dict[Tuple[str, str], str] = {}
+        for group_id, users in self.user_data.items():
+            for user_id, nickname in users.items():
+                self._path_index[(group_id, user_id)] = self._ics_file_path(group_id, user_id, nickname)
         self.binding_requests: Dict[str, Dict] = {}
+        self._reaper_task: Optional[asyncio.Task] = None
+        self._user_data_dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        # 串行化对 userdata.json 的写入，避免后台写入与卸载时的写入交错
+        self._user_data_lock = threading.Lock()
+        # 课表解析缓存：路径 -> (mtime_ns, size, 课程列表)
+        self._parse_cache: Dict[str, Tuple[int, int, List[Course]]] = {}
+        # 当日课程缓存：路径 -> (日期, 解析结果, 当日按开始时间排序的课程)
+        self._today_cache: Dict[str, Tuple[date, List[Course], TodaySchedule]] = {}
+        # 课表日期索引：路径 -> (mtime_ns, size, 有课的日期)，同时保存在 .dates.json 中
+        self._date_index: Dict[str, Tuple[int, int, Set[date]]] = {}
+        # 解析课表的线程池，群友课表查询时并发解析多个文件
+        self._parse_pool = ThreadPoolExecutor(max_workers=8)
+
+        # 字体只查找一次，各字号的字体对象在首次渲染时加载并缓存
+        self._font_path = self._find_font_file()
+        if not self._font_path:
+            logger.warning("未在插件目录中找到字体文件，将使用默认字体。")
+        self._fonts: Dict[int, ImageFont.ImageFont] = {}
+        # 已渲染好的标题区域，按标题文字缓存
+        self._title_cache: Dict[str, Image.Image] = {}
+        # 预渲染的状态标签和箭头，逐行直接粘贴
+        self._status_sprites: Dict[str, Image.Image] = {}
+        self._arrow_sprite: Optional[Image.Image] = None
+
+        # 下载头像时复用同一个 HTTP 会话
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 限制同时下载头像的数量，避免大群一次性发起过多请求
+        self._avatar_sem: Optional[asyncio.Semaphore] = None
+        # 已裁剪为圆形的头像：(user_id, 尺寸) -> (生成时间, 图片)
+        self._avatar_img_cache: Dict[Tuple[str, int], Tuple[float, Image.Image]] = {}
+        self._circle_masks: Dict[int, Image.Image] = {}
 
     @filter.command("绑定课表")
     async def bind_schedule(self, event: AstrMessageEvent):
@@ -53,9 +144,21 @@ class Main(Star):
             "user_id": user_id,
             "nickname": nickname
         }
+        # 由后台任务统一清理过期请求，消息处理时只需查字典
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._expire_binding_requests())
 
         yield event.plain_result("请在60秒内，在本群内直接发送你的 .ics 文件。")
 
+    async def _expire_binding_requests(self):
+        """定期清理超时的绑定请求，没有待处理的请求时退出"""
+        while self.binding_requests:
+            await asyncio.sleep(BINDING_REAP_INTERVAL)
+            cutoff = time.time() - BINDING_TIMEOUT
+            expired = [k for k, v in self.binding_requests.items() if v["timestamp"] <= cutoff]
+            for key in expired:
+                del self.binding_requests[key]
+
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def handle_file_message(self, event: AstrMessageEvent):
         """处理文件消息，检查是否为课表绑定请求"""
@@ -73,11 +176,6 @@ class Main(Star):
 
         request = self.binding_requests[request_key]
 
-        # 检查是否超时（60秒）
-        if time.time() - request["timestamp"] > 60:
-            del self.binding_requests[request_key]
-            return
-
         # 获取消息链中的文件组件
         messages = event.get_messages()
         file_component = None
@@ -92,7 +190,7 @@ class Main(Star):
 
 
         nickname = request.get("nickname", user_id)
-        ics_file_path = self.ics_path / f"{user_id}_{nickname}_{group_id}.ics"
+        ics_file_path = self._ics_file_path(group_id, user_id, nickname)
 
         try:
             # 使用File组件的异步方法获取文件
@@ -119,14 +217,14 @@ class Main(Star):
         except Exception as e:
             logger.error(f"获取文件信息失败: {e}")
             yield event.plain_result(f"无法获取文件信息，绑定失败。错误：{str(e)}")
-            del self.binding_requests[request_key]
+            self.binding_requests.pop(request_key, None)
             return
 
         # 检查下载的文件是否存在
         if not os.path.exists(ics_file_path):
             logger.error(f"文件下载失败，文件不存在: {ics_file_path}")
             yield event.plain_result("文件下载失败，请重试。")
-            del self.binding_requests[request_key]
+            self.binding_requests.pop(request_key, None)
             return
         logger.info(event.message_obj.raw_message) # 平台下发的原始消息在这里
         logger.info(f"文件下载成功，文件路径: {ics_file_path}")
@@ -136,50 +234,203 @@ class Main(Star):
         if group_id not in self.user_data:
             self.user_data[group_id] = {}
         self.user_data[group_id][user_id] = nickname
+        self._path_index[(group_id, user_id)] = ics_file_path
 
         self._save_user_data()
 
         # 删除绑定请求
-        del self.binding_requests[request_key]
+        self.binding_requests.pop(request_key, None)
         yield event.plain_result(f"课表绑定成功！群号：{group_id}")
 
-    def _parse_ics_file(self, file_path: str) -> List[Dict]:
-        """解析 .ics 文件并返回课程列表"""
+    def _ics_file_path(self, group_id: str, user_id: str, nickname: str) -> str:
+        """返回用户在指定群绑定的课表文件路径"""
+        return str(self.ics_path / f"{user_id}_{nickname}_{group_id}.ics")
+
+    def _parse_ics_file(self, file_path: str) -> List[Course]:
+        """解析 .ics 文件并返回课程列表，文件未变化时直接返回缓存结果"""
+        file_path = str(file_path)
+        st = os.stat(file_path)
+        entry = self._parse_cache.get(file_path)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+
+        try:
+            courses = self._parse_ics_fast(file_path)
+        except Exception as e:
+            logger.warning(f"快速解析课表失败，改用 icalendar 解析: {file_path}, 错误: {e}")
+            courses = self._parse_ics_with_icalendar(file_path)
+
+        self._parse_cache[file_path] = (st.st_mtime_ns, st.st_size, courses)
+        self._save_date_index(file_path, st, {c.start_time.date() for c in courses})
+        return courses
+
+    def _load_date_index(self, file_path: str, st: os.stat_result) -> Optional[Set[date]]:
+        """读取课表的日期索引，索引不存在或已过期时返回 None"""
+        entry = self._date_index.get(file_path)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        try:
+            index = orjson.loads(Path(file_path).with_suffix(".dates.json").read_bytes())
+            if index.get("mtime_ns") != st.st_mtime_ns or index.get("size") != st.st_size:
+                return None
+            dates = {date.fromisoformat(d) for d in index.get("dates", [])}
+        except (OSError, ValueError, TypeError, AttributeError):
+            # 索引损坏时当作不存在，之后解析课表会重新生成
+            return None
+        self._date_index[file_path] = (st.st_mtime_ns, st.st_size, dates)
+        return dates
+
+    def _save_date_index(self, file_path: str, st: os.stat_result, dates: Set[date]):
+        """保存课表的日期索引，供之后跳过当天没有课的课表"""
+        self._date_index[file_path] = (st.st_mtime_ns, st.st_size, dates)
+        index = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "dates": sorted(dates)}
+        try:
+            Path(file_path).with_suffix(".dates.json").write_bytes(orjson.dumps(index))
+        except OSError as e:
+            logger.warning(f"保存课表日期索引失败: {file_path}, 错误: {e}")
+
+    def _parse_ics_fast(self, file_path: str) -> List[Course]:
+        """逐行解析 .ics 文件，只提取 VEVENT 中的 SUMMARY/LOCATION/DTSTART/DTEND"""
+        with open(file_path, "rb") as f:
+            data = f.read()
+        # 展开折行：以空格或制表符开头的行是上一行的延续
+        data = re.sub(rb"\r?\n[ \t]", b"", data)
+
         courses = []
-        with open(file_path, "r", encoding="utf-8") as f:
+        _append = courses.append
+        event = None
+        depth = 0
+        for line in data.splitlines():
+            if line.startswith(b"BEGIN:"):
+                if event is not None:
+                    depth += 1  # VEVENT 内嵌的 VALARM 等组件
+                elif line.rstrip() == b"BEGIN:VEVENT":
+                    event = {}
+                continue
+            if line.startswith(b"END:"):
+                if event is None:
+                    continue
+                if depth:
+                    depth -= 1
+                elif line.rstrip() == b"END:VEVENT":
+                    if "start_time" not in event or "end_time" not in event:
+                        raise ValueError("VEVENT 缺少 DTSTART 或 DTEND")
+                    # DTSTART 为日期的全天事件（节假日等）不是课程，跳过
+                    if event["start_time"] is not None:
+                        if event["end_time"] is None:
+                            raise ValueError("VEVENT 的 DTEND 不是日期时间")
+                        _append(Course(
+                            event.get("summary"), event.get("location"), event["start_time"], event["end_time"]
+                        ))
+                    event = None
+                continue
+            if event is None or depth:
+                continue
+
+            match = ICS_PROP_RE.match(line)
+            if not match:
+                continue
+            name, params, value = match.groups()
+            if name == b"DTSTART":
+                event["start_time"] = self._parse_ics_datetime(value.strip(), params)
+            elif name == b"DTEND":
+                event["end_time"] = self._parse_ics_datetime(value.strip(), params)
+            else:
+                event[name.decode().lower()] = self._unescape_ics_text(value.decode("utf-8"))
+        return courses
+
+    @staticmethod
+    def _parse_ics_datetime(value: bytes, params: bytes) -> Optional[datetime]:
+        """解析 DTSTART/DTEND 的值，统一转换为上海时区 (UTC+8)；VALUE=DATE 的日期值返回 None"""
+        v = value.decode("ascii")
+        if len(v) == 8:
+            return None
+        if len(v) not in (15, 16) or v[8] != "T":
+            raise ValueError(f"无法识别的时间格式: {v}")
+        dt = datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]),
+                      int(v[9:11]), int(v[11:13]), int(v[13:15]))
+        if v.endswith("Z"):
+            return dt.replace(tzinfo=timezone.utc).astimezone(SHANGHAI_TZ)
+        tzid = ICS_TZID_RE.search(params)
+        if tzid:
+            try:
+                return dt.replace(tzinfo=ZoneInfo(tzid.group(1).decode())).astimezone(SHANGHAI_TZ)
+            except Exception:
+                pass
+        # 没有时区信息（或无法识别的 TZID），假设是上海时间
+        return dt.replace(tzinfo=SHANGHAI_TZ)
+
+    @staticmethod
+    def _unescape_ics_text(text: str) -> str:
+        """还原 iCalendar TEXT 值中的转义字符"""
+        if "\\" not in text:
+            return text
+        return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+    def _parse_ics_with_icalendar(self, file_path: str) -> List[Course]:
+        """使用 icalendar 完整解析 .ics 文件，作为快速解析失败时的后备方案"""
+        courses = []
+        _append = courses.append
+        # icalendar 可以直接解析 bytes，省去一次完整的解码
+        with open(file_path, "rb") as f:
             cal = Calendar.from_ical(f.read())
             for component in cal.walk():
                 if component.name == "VEVENT":
                     summary = component.get("summary")
-                    description = component.get("description")
                     location = component.get("location")
                     dtstart = component.get("dtstart").dt
                     dtend = component.get("dtend").dt
+                    # DTSTART 为日期的全天事件（节假日等）不是课程，跳过
+                    if not isinstance(dtstart, datetime):
+                        continue
 
-                    # 确保 datetime 对象有时区信息，如果没有则添加 UTC 时区
-                    if hasattr(dtstart, "tzinfo") and dtstart.tzinfo is not None:
-                        # 如果有时区信息，转换为 UTC
-                        dtstart = dtstart.astimezone(timezone(timedelta(hours=8)))
-                    else:
-                        # 如果没有时区信息，假设是 UTC
-                        dtstart = dtstart.replace(tzinfo=timezone(timedelta(hours=8)))
+                    # 有时区信息则转换为上海时区，没有则假设是上海时间
+                    dtstart = dtstart.astimezone(SHANGHAI_TZ) if getattr(dtstart, "tzinfo", None) else dtstart.replace(tzinfo=SHANGHAI_TZ)
+                    dtend = dtend.astimezone(SHANGHAI_TZ) if getattr(dtend, "tzinfo", None) else dtend.replace(tzinfo=SHANGHAI_TZ)
 
-                    if hasattr(dtend, "tzinfo") and dtend.tzinfo is not None:
-                        # 如果有时区信息，转换为 UTC
-                        dtend = dtend.astimezone(timezone(timedelta(hours=8)))
-                    else:
-                        # 如果没有时区信息，假设是 UTC
-                        dtend = dtend.replace(tzinfo=timezone(timedelta(hours=8)))
-
-                    courses.append({
-                        "summary": summary,
-                        "description": description,
-                        "location": location,
-                        "start_time": dtstart,
-                        "end_time": dtend
-                    })
+                    # 只保留后续会用到的字段，description 未被使用，不再缓存
+                    _append(Course(summary, location, dtstart, dtend))
         return courses
 
+    def _get_today_courses(self, file_path: str, today: date) -> TodaySchedule:
+        """返回指定日期按开始时间排序的课程及其起止时间，课表未变化时直接复用缓存"""
+        file_path = str(file_path)
+        st = os.stat(file_path)
+        entry = self._parse_cache.get(file_path)
+        if not (entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size):
+            # 尚未解析过的课表先查日期索引，当天没有课就不必解析
+            dates = self._load_date_index(file_path, st)
+            if dates is not None and today not in dates:
+                return [], [], [], []
+
+        courses = self._parse_ics_file(file_path)
+        entry = self._today_cache.get(file_path)
+        # _parse_ics_file 命中缓存时返回同一个列表对象，可据此判断课表是否变化
+        if entry and entry[0] == today and entry[1] is courses:
+            return entry[2]
+
+        # 复制当天的课程并预先格式化起止时间，渲染时无需再调用 strftime
+        today_courses = [
+            TodayCourse(
+                c.summary, c.location, c.start_time, c.end_time,
+                c.start_time.strftime("%H:%M"), c.end_time.strftime("%H:%M")
+            )
+            for c in courses if c.start_time.date() == today
+        ]
+        today_courses.sort(key=lambda x: x.start_time)
+        max_ends: List[datetime] = []
+        max_idx: List[int] = []
+        for i, c in enumerate(today_courses):
+            if not max_ends or c.end_time > max_ends[-1]:
+                max_ends.append(c.end_time)
+                max_idx.append(i)
+            else:
+                max_ends.append(max_ends[-1])
+                max_idx.append(max_idx[-1])
+        schedule = ([c.start_time for c in today_courses], max_ends, max_idx, today_courses)
+        self._today_cache[file_path] = (today, courses, schedule)
+        return schedule
+
     @filter.command("查看课表")
     async def show_today_schedule(self, event: AstrMessageEvent):
         """查看今天还有什么课"""
@@ -193,36 +444,23 @@ class Main(Star):
             )
             return
 
-        nickname = self.user_data[group_id].get(user_id, user_id)
-        ics_file_path = self.ics_path / f"{user_id}_{nickname}_{group_id}.ics"
-        if not os.path.exists(ics_file_path):
-            yield event.plain_result("课表文件不存在，可能已被删除。请重新绑定。")
-            return
-
-        courses = self._parse_ics_file(ics_file_path)
-        today_courses = []
         # 使用上海时区 (UTC+8)
-        shanghai_tz = timezone(timedelta(hours=8))
-        now = datetime.now(shanghai_tz)
+        now = datetime.now(SHANGHAI_TZ)
 
-        for course in courses:
-            if (course["start_time"].date() == now.date() and
-                    course["start_time"] > now):
-                today_courses.append(course)
+        # 当日课程已按开始时间排序，二分找到第一节还没开始的课
+        try:
+            starts, _, _, all_today = self._get_today_courses(self._path_index[(group_id, user_id)], now.date())
+        except FileNotFoundError:
+            yield event.plain_result("课表文件不存在，可能已被删除。请重新绑定。")
+            return
+        today_courses = all_today[bisect.bisect_right(starts, now):]
 
         if not today_courses:
             yield event.plain_result("你今天没有课啦！")
             return
 
-        # Sort courses by start time
-        today_courses.sort(key=lambda x: x["start_time"])
-
-        # Add user_id to each course for image generation
-        for course in today_courses:
-            course["nickname"] = self.user_data[group_id].get(user_id, user_id)
-
-        image_path = await self._generate_user_schedule_image(today_courses, event.get_sender_name())
-        yield event.image_result(image_path)
+        image_bytes = await self._generate_user_schedule_image(today_courses, event.get_sender_name(), now)
+        yield event.chain_result([Comp.Image.fromBytes(image_bytes)])
 
     @filter.command("群友上什么课")
     async def show_group_schedule(self, event: AstrMessageEvent):
@@ -233,73 +471,56 @@ class Main(Star):
             return
 
         # 使用上海时区 (UTC+8)
-        shanghai_tz = timezone(timedelta(hours=8))
-        now = datetime.now(shanghai_tz)
+        now = datetime.now(SHANGHAI_TZ)
         next_courses = []
 
-        for user_id, nickname in self.user_data[group_id].items():
-            ics_file_path = self.ics_path / f"{user_id}_{nickname}_{group_id}.ics"
-            if not os.path.exists(ics_file_path):
-                continue
+        users = list(self.user_data[group_id].items())
 
-            courses = self._parse_ics_file(ics_file_path)
+        # 只取当天的课程进行判断，在线程池中并发解析各用户的课表
+        loop = asyncio.get_running_loop()
+        tasks = [
+            loop.run_in_executor(
+                self._parse_pool, self._get_today_courses, self._path_index[(group_id, user_id)], now.date()
+            )
+            for user_id, _ in users
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for (user_id, nickname), schedule in zip(users, results):
+            if isinstance(schedule, Exception):
+                # 课表文件不存在的用户直接跳过
+                if not isinstance(schedule, FileNotFoundError):
+                    logger.error(f"解析课表失败: {self._path_index[(group_id, user_id)]}, 错误: {schedule}")
+                continue
+            starts, max_ends, max_idx, today_courses = schedule
             user_current_course = None
             user_next_course = None
 
-            # 只筛选当天的课程进行判断
-            today_courses = [c for c in courses if c.get("start_time") and c.get("start_time").date() == now.date()]
-
-            for course in today_courses:
-                start_time = course.get("start_time")
-                end_time = course.get("end_time")
-
-                if start_time and end_time:
-                    # 检查是否是正在进行的课程
-                    if start_time <= now < end_time:
-                        user_current_course = course
-                        break  # 找到正在上的课，就不需要再找下一节了
-
-                    # 检查是否是未来的课程
-                    elif start_time > now:
-                        if user_next_course is None or start_time < user_next_course.get("start_time"):
-                            user_next_course = course
+            # idx 之前的课程都已开始，其中结束最晚的一节若还没结束就是正在进行的课，idx 是下一节
+            idx = bisect.bisect_right(starts, now)
+            if idx > 0 and max_ends[idx - 1] > now:
+                user_current_course = today_courses[max_idx[idx - 1]]
+            if idx < len(today_courses):
+                user_next_course = today_courses[idx]
 
             # 优先显示正在上的课
             display_course = user_current_course if user_current_course else user_next_course
 
             if display_course:
-                # 创建课程对象的深拷贝，避免引用问题
-                user_course_copy = {
-                    "summary": display_course["summary"],
-                    "description": display_course["description"],
-                    "location": display_course["location"],
-                    "start_time": display_course["start_time"],
-                    "end_time": display_course["end_time"],
-                    "user_id": user_id,
-                    "nickname": nickname
-                }
-                next_courses.append(user_course_copy)
+                # 缓存中的课程对象是共享的，用 GroupEntry 附加用户信息而不修改它
+                next_courses.append(GroupEntry(display_course, user_id, nickname))
 
         if not next_courses:
             yield event.plain_result("群友们接下来都没有课啦！")
             return
 
-        next_courses.sort(key=lambda x: x["start_time"])
+        next_courses.sort(key=lambda x: x.course.start_time)
 
-        result_str = "接下来群友们的课程有：\n"
-        for course in next_courses:
-            result_str += f"\n用户: {course['user_id']}\n"
-            result_str += f"课程名称: {course['summary']}\n"
-            result_str += (f"时间: {course['start_time'].strftime('%H:%M')} - "
-                          f"{course['end_time'].strftime('%H:%M')}\n")
-            result_str += f"地点: {course['location']}\n"
+        image_bytes = await self._generate_schedule_image(next_courses, now)
+        yield event.chain_result([Comp.Image.fromBytes(image_bytes)])
 
-        # Instead of sending plain text, we will generate and send an image.
-        image_bytes = await self._generate_schedule_image(next_courses)
-        yield event.image_result(image_bytes)
-
-    async def _generate_schedule_image(self, courses: List[Dict]) -> str:
-        """生成课程表图片并返回临时文件路径"""
+    async def _generate_schedule_image(self, entries: List[GroupEntry], now: datetime) -> bytes:
+        """生成课程表图片并返回 PNG 数据"""
         # --- 样式配置 ---
         BG_COLOR = "#FFFFFF"
         FONT_COLOR = "#333333"
@@ -315,83 +536,55 @@ class Main(Star):
         ROW_HEIGHT = 120
         PADDING = 40
 
-        # --- 动态字体加载 ---
-        font_path = self._find_font_file()
-        if font_path:
-            try:
-                font_main = ImageFont.truetype(font_path, 32)
-                font_sub = ImageFont.truetype(font_path, 24)
-                font_title = ImageFont.truetype(font_path, 48)
-            except IOError:
-                logger.warning(f"无法加载字体文件: {font_path}，将使用默认字体。")
-                font_main = ImageFont.load_default()
-                font_sub = ImageFont.load_default()
-                font_title = ImageFont.load_default()
-        else:
-            logger.warning("未在插件目录中找到字体文件，将使用默认字体。")
-            font_main = ImageFont.load_default()
-            font_sub = ImageFont.load_default()
-            font_title = ImageFont.load_default()
+        # --- 字体加载（已缓存） ---
+        font_main = self._get_font(32)
+        font_sub = self._get_font(24)
 
         # --- 图像尺寸计算 ---
         width = 800
-        height = PADDING * 2 + 120 + len(courses) * ROW_HEIGHT
+        height = PADDING * 2 + 120 + len(entries) * ROW_HEIGHT
         image = Image.new("RGB", (width, height), BG_COLOR)
         draw = ImageDraw.Draw(image)
 
         # --- 绘制标题 ---
-        draw.rectangle([PADDING, PADDING, PADDING + 20, PADDING + 60], fill="#26A69A")
-        draw.text((PADDING + 40, PADDING), "“群友在上什么课?”", font=font_title, fill=TITLE_COLOR)
-        draw.rectangle([PADDING + 40, PADDING + 70, PADDING + 40 + 300, PADDING + 75], fill="#A7FFEB")
+        title = "“群友在上什么课?”"
+        title_strip = self._title_cache.get(title)
+        if title_strip is None:
+            title_strip = Image.new("RGB", (width - PADDING * 2, 120), BG_COLOR)
+            title_draw = ImageDraw.Draw(title_strip)
+            title_draw.rectangle([0, 0, 20, 60], fill="#26A69A")
+            title_draw.text((40, 0), title, font=self._get_font(48), fill=TITLE_COLOR)
+            title_draw.rectangle([40, 70, 40 + 300, 75], fill="#A7FFEB")
+            self._title_cache[title] = title_strip
+        image.paste(title_strip, (PADDING, PADDING))
 
         # --- 获取头像 ---
-        async def fetch_avatar(session, user_id):
-            avatar_url = f"http://q.qlogo.cn/headimg_dl?dst_uin={user_id}&spec=640&img_type=jpg"
-            try:
-                async with session.get(avatar_url) as response:
-                    if response.status == 200:
-                        return await response.read()
-            except Exception as e:
-                logger.error(f"Failed to download avatar for {user_id}: {e}")
-            return None
-
-        async with aiohttp.ClientSession() as session:
-            tasks = [fetch_avatar(session, course.get("user_id", "N/A")) for course in courses]
-            avatar_datas = await asyncio.gather(*tasks)
+        # 同一用户只获取一次头像
+        user_ids = list({entry.user_id for entry in entries})
+        tasks = [self._get_avatar_image(user_id, AVATAR_SIZE) for user_id in user_ids]
+        avatars = dict(zip(user_ids, await asyncio.gather(*tasks)))
 
         # --- 绘制每一行 ---
         y_offset = PADDING + 120
-        now = datetime.now(timezone(timedelta(hours=8)))
+        arrow_sprite = self._get_arrow_sprite()
 
-        for i, course in enumerate(courses):
-            user_id = course.get("user_id", "N/A")
-            nickname = course.get("nickname", user_id)
-            summary = course.get("summary", "无课程信息")
-            start_time = course.get("start_time")
-            end_time = course.get("end_time")
+        for entry in entries:
+            course = entry.course
+            user_id = entry.user_id
+            nickname = entry.nickname
+            summary = course.summary
+            start_time = course.start_time
+            end_time = course.end_time
 
             # --- 绘制头像 ---
-            avatar_data = avatar_datas[i]
-            if avatar_data:
-                avatar = Image.open(BytesIO(avatar_data)).convert("RGBA")
-                avatar = avatar.resize((AVATAR_SIZE, AVATAR_SIZE))
-
-                # 创建圆形遮罩
-                mask = Image.new("L", (AVATAR_SIZE, AVATAR_SIZE), 0)
-                mask_draw = ImageDraw.Draw(mask)
-                mask_draw.ellipse((0, 0, AVATAR_SIZE, AVATAR_SIZE), fill=255)
-
-                image.paste(avatar, (PADDING, y_offset + (ROW_HEIGHT - AVATAR_SIZE) // 2), mask)
+            avatar = avatars[user_id]
+            if avatar:
+                image.paste(avatar, (PADDING, y_offset + (ROW_HEIGHT - AVATAR_SIZE) // 2), avatar)
 
             # --- 绘制箭头 ---
             arrow_x = PADDING + AVATAR_SIZE + 20
             arrow_y = y_offset + ROW_HEIGHT // 2
-            arrow_points = [
-                (arrow_x, arrow_y - 20),
-                (arrow_x + 30, arrow_y),
-                (arrow_x, arrow_y + 20)
-            ]
-            draw.polygon(arrow_points, fill="#BDBDBD")
+            image.paste(arrow_sprite, (arrow_x, arrow_y - 20), arrow_sprite)
 
             # --- 状态判断和绘制 ---
             status_text = ""
@@ -423,13 +616,16 @@ class Main(Star):
             text_x = arrow_x + 50
             draw.text((text_x, y_offset + 15), str(nickname), font=font_main, fill=FONT_COLOR)
 
-            status_bg, status_fg = STATUS_COLORS.get(status_text, ("#000000", "#FFFFFF"))
-            draw.rectangle([text_x, y_offset + 60, text_x + 100, y_offset + 95], fill=status_bg)
-            draw.text((text_x + 10, y_offset + 65), status_text, font=font_sub, fill=status_fg)
+            status_sprite = self._status_sprites.get(status_text)
+            if status_sprite is None:
+                status_bg, status_fg = STATUS_COLORS.get(status_text, ("#000000", "#FFFFFF"))
+                status_sprite = self._render_status_sprite(status_text, status_bg, status_fg, font_sub)
+                self._status_sprites[status_text] = status_sprite
+            image.paste(status_sprite, (text_x, y_offset + 60), status_sprite)
 
             draw.text((text_x + 120, y_offset + 65), summary, font=font_sub, fill=FONT_COLOR)
             if start_time and end_time:
-                time_str = f"{start_time.strftime('%H:%M')}-{end_time.strftime('%H:%M')}"
+                time_str = f"{course.start_hm}-{course.end_hm}"
                 draw.text((text_x + 120, y_offset + 95), f"{time_str} ({detail_text})", font=font_sub, fill=SUBTITLE_COLOR)
             else:
                  draw.text((text_x + 120, y_offset + 95), detail_text, font=font_sub, fill=SUBTITLE_COLOR)
@@ -437,15 +633,13 @@ class Main(Star):
 
             y_offset += ROW_HEIGHT
 
-        # --- 保存到临时文件 ---
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        image.save(temp_path, format="PNG")
-        temp_file.close()
-
-        return temp_path
+        # --- 编码为 PNG ---
+        # 图片只发送一次，用低压缩等级换取更快的编码速度
+        buffer = BytesIO()
+        image.save(buffer, format="PNG", optimize=False, compress_level=1)
+        return buffer.getvalue()
 
-    async def _generate_user_schedule_image(self, courses: List[Dict], nickname: str) -> str:
+    async def _generate_user_schedule_image(self, courses: List[TodayCourse], nickname: str, now: datetime) -> bytes:
         """为单个用户生成今日课程表图片"""
         # --- 样式配置 ---
         BG_COLOR = "#FFFFFF"
@@ -456,23 +650,10 @@ class Main(Star):
         ROW_HEIGHT = 100
         PADDING = 40
 
-        # --- 动态字体加载 ---
-        font_path = self._find_font_file()
-        if font_path:
-            try:
-                font_main = ImageFont.truetype(font_path, 28)
-                font_sub = ImageFont.truetype(font_path, 22)
-                font_title = ImageFont.truetype(font_path, 40)
-            except IOError:
-                logger.warning(f"无法加载字体文件: {font_path}，将使用默认字体。")
-                font_main = ImageFont.load_default()
-                font_sub = ImageFont.load_default()
-                font_title = ImageFont.load_default()
-        else:
-            logger.warning("未在插件目录中找到字体文件，将使用默认字体。")
-            font_main = ImageFont.load_default()
-            font_sub = ImageFont.load_default()
-            font_title = ImageFont.load_default()
+        # --- 字体加载（已缓存） ---
+        font_main = self._get_font(28)
+        font_sub = self._get_font(22)
+        font_title = self._get_font(40)
 
         # --- 图像尺寸计算 ---
         width = 800
@@ -487,16 +668,18 @@ class Main(Star):
         y_offset = PADDING + 100
 
         for course in courses:
-            summary = course.get("summary", "无课程信息")
-            start_time = course.get("start_time")
-            end_time = course.get("end_time")
-            location = course.get("location", "未知地点")
+            summary = course.summary
+            location = course.location
 
-            # 绘制圆角矩形背景
-            self._draw_rounded_rectangle(draw, [PADDING, y_offset, width - PADDING, y_offset + ROW_HEIGHT - 10], 10, fill=COURSE_BG_COLOR)
+            # 绘制圆角矩形背景，Pillow >= 8.2 使用原生实现
+            box = [PADDING, y_offset, width - PADDING, y_offset + ROW_HEIGHT - 10]
+            if hasattr(draw, "rounded_rectangle"):
+                draw.rounded_rectangle(box, radius=10, fill=COURSE_BG_COLOR)
+            else:
+                self._draw_rounded_rectangle(draw, box, 10, fill=COURSE_BG_COLOR)
 
             # 绘制时间
-            time_str = f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}"
+            time_str = f"{course.start_hm} - {course.end_hm}"
             draw.text((PADDING + 20, y_offset + 15), time_str, font=font_main, fill=TITLE_COLOR)
 
             # 绘制课程名称和地点
@@ -505,19 +688,115 @@ class Main(Star):
             y_offset += ROW_HEIGHT
 
         # --- 绘制页脚 ---
-        footer_text = f"生成时间: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}"
+        footer_text = f"生成时间: {now.strftime('%Y/%m/%d %H:%M:%S')}"
         draw.text((PADDING, height - PADDING), footer_text, font=font_sub, fill=SUBTITLE_COLOR)
 
-        # --- 保存到临时文件 ---
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        image.save(temp_path, format="PNG")
-        temp_file.close()
+        # --- 编码为 PNG ---
+        # 图片只发送一次，用低压缩等级换取更快的编码速度
+        buffer = BytesIO()
+        image.save(buffer, format="PNG", optimize=False, compress_level=1)
+        return buffer.getvalue()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取复用的 HTTP 会话，首次使用时创建"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=64, limit_per_host=8, keepalive_timeout=30)
+            )
+        return self._session
+
+    async def _fetch_avatar(self, user_id: str) -> Optional[bytes]:
+        """下载用户头像的原始数据，缓存由 _get_avatar_image 负责"""
+        if self._avatar_sem is None:
+            self._avatar_sem = asyncio.Semaphore(8)
+        avatar_url = f"http://q.qlogo.cn/headimg_dl?dst_uin={user_id}&spec=640&img_type=jpg"
+        try:
+            async with self._avatar_sem:
+                async with self._get_session().get(avatar_url) as response:
+                    if response.status == 200:
+                        return await response.read()
+        except Exception as e:
+            logger.error(f"Failed to download avatar for {user_id}: {e}")
+        return None
+
+    async def _get_avatar_image(self, user_id: str, size: int) -> Optional[Image.Image]:
+        """获取已缩放并裁剪为圆形的头像，优先使用内存和磁盘缓存"""
+        now = time.time()
+        key = (user_id, size)
+        entry = self._avatar_img_cache.get(key)
+        if entry and now - entry[0] < AVATAR_MEM_TTL:
+            return entry[1]
+
+        # 顺带清理已过期的内存缓存，避免随用户数增长
+        expired = [k for k, v in self._avatar_img_cache.items() if now - v[0] >= AVATAR_MEM_TTL]
+        for k in expired:
+            del self._avatar_img_cache[k]
+
+        loop = asyncio.get_running_loop()
+        avatar_file = self.avatar_path / f"{user_id}_{size}.png"
+        try:
+            st = avatar_file.stat()
+            if now - st.st_mtime < AVATAR_DISK_TTL:
+                avatar = await loop.run_in_executor(None, self._load_avatar_png, avatar_file)
+                self._avatar_img_cache[key] = (now, avatar)
+                return avatar
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"读取头像缓存失败: {avatar_file}, 错误: {e}")
 
-        return temp_path
+        data = await self._fetch_avatar(user_id)
+        if not data:
+            return None
+        try:
+            avatar = Image.open(BytesIO(data)).convert("RGBA").resize((size, size), Image.BILINEAR)
+        except Exception as e:
+            logger.error(f"Failed to decode avatar for {user_id}: {e}")
+            return None
+        avatar.putalpha(self._get_circle_mask(size))
+        self._avatar_img_cache[key] = (now, avatar)
+        # 磁盘缓存写入失败不影响本次渲染
+        try:
+            await loop.run_in_executor(None, avatar.save, avatar_file, "PNG")
+        except Exception as e:
+            logger.warning(f"保存头像缓存失败: {avatar_file}, 错误: {e}")
+        return avatar
+
+    @staticmethod
+    def _load_avatar_png(avatar_file: Path) -> Image.Image:
+        """从磁盘读取已处理好的头像"""
+        avatar = Image.open(avatar_file)
+        avatar.load()
+        return avatar
+
+    def _get_circle_mask(self, size: int) -> Image.Image:
+        """获取指定尺寸的圆形遮罩"""
+        mask = self._circle_masks.get(size)
+        if mask is None:
+            mask = Image.new("L", (size, size), 0)
+            ImageDraw.Draw(mask).ellipse((0, 0, size, size), fill=255)
+            self._circle_masks[size] = mask
+        return mask
+
+    @staticmethod
+    def _render_status_sprite(text: str, bg: str, fg: str, font: ImageFont.ImageFont) -> Image.Image:
+        """渲染一个状态标签（底色 + 文字）"""
+        sprite = Image.new("RGBA", (101, 36), (0, 0, 0, 0))
+        sprite_draw = ImageDraw.Draw(sprite)
+        sprite_draw.rectangle([0, 0, 100, 35], fill=bg)
+        sprite_draw.text((10, 5), text, font=font, fill=fg)
+        return sprite
+
+    def _get_arrow_sprite(self) -> Image.Image:
+        """获取行首的箭头图形，首次使用时渲染"""
+        if self._arrow_sprite is None:
+            sprite = Image.new("RGBA", (31, 41), (0, 0, 0, 0))
+            ImageDraw.Draw(sprite).polygon([(0, 0), (30, 20), (0, 40)], fill="#BDBDBD")
+            self._arrow_sprite = sprite
+        return self._arrow_sprite
 
     def _draw_rounded_rectangle(self, draw, xy, radius, fill):
-        """手动绘制圆角矩形"""
+        """手动绘制圆角矩形，用于不支持 rounded_rectangle 的旧版 Pillow"""
         x1, y1, x2, y2 = xy
         draw.rectangle([x1, y1 + radius, x2, y2 - radius], fill=fill)
         draw.rectangle([x1 + radius, y1, x2 - radius, y2], fill=fill)
@@ -526,34 +805,94 @@ class Main(Star):
         draw.pieslice([x1, y2 - radius * 2, x1 + radius * 2, y2], 90, 180, fill=fill)
         draw.pieslice([x2 - radius * 2, y2 - radius * 2, x2, y2], 0, 90, fill=fill)
 
+    def _get_font(self, size: int) -> ImageFont.ImageFont:
+        """获取指定字号的字体，首次使用时加载"""
+        font = self._fonts.get(size)
+        if font is None:
+            font = ImageFont.load_default()
+            if self._font_path:
+                try:
+                    font = ImageFont.truetype(self._font_path, size)
+                except IOError:
+                    logger.warning(f"无法加载字体文件: {self._font_path}，将使用默认字体。")
+            self._fonts[size] = font
+        return font
+
     def _find_font_file(self) -> str:
-        """在插件目录中查找第一个 .ttf 或 .otf 字体文件"""
+        """查找字体文件：优先使用插件目录下的 font.ttf，否则取第一个 .ttf 或 .otf 文件"""
         plugin_dir = os.path.dirname(__file__)
-        for filename in os.listdir(plugin_dir):
-            if filename.lower().endswith((".ttf", ".otf")):
-                return os.path.join(plugin_dir, filename)
+        preferred = os.path.join(plugin_dir, "font.ttf")
+        if os.path.isfile(preferred):
+            return preferred
+        with os.scandir(plugin_dir) as it:
+            for entry in it:
+                if entry.name.lower().endswith((".ttf", ".otf")) and entry.is_file():
+                    return entry.path
         return ""
 
     def _load_user_data(self) -> Dict:
         """加载用户数据"""
         try:
-            with open(self.user_data_file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            return orjson.loads(self.user_data_file.read_bytes())
         except FileNotFoundError:
             return {}
 
     def _save_user_data(self):
-        """保存用户数据"""
-        with open(self.user_data_file, "w", encoding="utf-8") as f:
-            json.dump(self.user_data, f, ensure_ascii=False, indent=4)
+        """标记用户数据待保存，由后台任务延迟写入"""
+        self._user_data_dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._flush_user_data())
+
+    async def _flush_user_data(self):
+        """等待一段时间后将用户数据写入文件，写入在线程池中进行"""
+        # 写入期间发生的修改会再次置脏，循环直到没有待保存的数据
+        while self._user_data_dirty:
+            await asyncio.sleep(USER_DATA_SAVE_DELAY)
+            self._user_data_dirty = False
+            data = self._dump_user_data()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_user_data, data)
+            except asyncio.CancelledError:
+                # 被取消时不确定写入是否完成，交由 terminate 重新写入
+                self._user_data_dirty = True
+                raise
+            except Exception as e:
+                self._user_data_dirty = True
+                logger.error(f"保存用户数据失败: {e}")
+                return
+
+    def _write_user_data(self, data: bytes):
+        """写入用户数据文件"""
+        with self._user_data_lock:
+            self.user_data_file.write_bytes(data)
+
+    def _dump_user_data(self) -> bytes:
+        """序列化用户数据"""
+        return orjson.dumps(self.user_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
 
     def _init_data(self):
         """初始化插件数据文件和目录"""
         self.data_path.mkdir(parents=True, exist_ok=True)
         self.ics_path.mkdir(exist_ok=True)
+        self.avatar_path.mkdir(exist_ok=True)
         if not self.user_data_file.exists():
-            with open(self.user_data_file, "w", encoding="utf-8") as f:
-                json.dump({}, f)
+            self.user_data_file.write_bytes(b"{}")
 
     async def terminate(self):
+        if self._reaper_task is not None and not self._reaper_task.done():
+            self._reaper_task.cancel()
+        # 插件卸载前立即写入尚未保存的用户数据
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+        if self._user_data_dirty:
+            # 已在线程池中执行的写入无法取消，通过锁等待其完成后再写
+            self._write_user_data(self._dump_user_data())
+            self._user_data_dirty = False
+        self._parse_pool.shutdown(wait=False)
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
         logger.info("Course Schedule plugin terminated.")